@@ -1,12 +1,14 @@
-import glob
+import copy
 import hashlib
-import json
 import zipfile
 from argparse import ArgumentParser, Namespace
-from os import listdir, makedirs
-from os.path import basename, dirname, exists, isfile, join
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from os import cpu_count, makedirs, replace, scandir, stat
+from os.path import abspath, basename, exists, isdir, isfile, join
 from typing import List, Mapping
 
+import orjson
 import ruamel.yaml
 from colorama import Fore, init
 from PyInquirer import prompt
@@ -23,8 +25,163 @@ ADAPTER_KEYS_TO_COPY = ["type", "model_type", "model_name", "model_class"]
 
 ADAPTER_PACK_METADATA_FILE = join(ADAPTER_CACHE, "pack_metadata.json")
 
+# maps model directories to the adapters previously extracted from them
+ADAPTER_EXTRACT_CACHE_FILE = join(ADAPTER_CACHE, "extract_cache.json")
+
 DEFAULT_OUTPUT_PATH = ".PACK_OUTPUT"
 
+CHUNK_SIZE = 1 << 20  # 1 MiB
+
+FOLDER_NAME_TRANSLATION = str.maketrans("/", "-")
+
+
+class _HashingWriter:
+    """Write-only file wrapper updating checksums of all bytes written through it.
+
+    It is intentionally not seekable, so that zipfile writes the archive strictly sequentially.
+    """
+
+    def __init__(self, f, algos):
+        self._f = f
+        self.hashes = {algo: hashlib.new(algo) for algo in algos}
+
+    def write(self, b):
+        for h in self.hashes.values():
+            h.update(b)
+        return self._f.write(b)
+
+    def flush(self):
+        self._f.flush()
+
+
+def _copy_file(src, dst, buffer):
+    # copies through a reused buffer, all bytes must pass zipfile's crc and our checksums anyway
+    view = memoryview(buffer)
+    while True:
+        size = src.readinto(buffer)
+        if not size:
+            break
+        dst.write(view[:size])
+
+
+def _folder_size(folder):
+    try:
+        with scandir(folder) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.is_file())
+    except OSError:
+        return 0
+
+
+def _find_dirs_containing(root, file_names):
+    """Walks the directory tree below root once and collects all directories containing any of the given files.
+
+    Like glob's '**', hidden entries are skipped and symlinks to directories are followed. Directories reached
+    more than once (e.g. through symlink loops) are only visited once.
+
+    Returns:
+        dict: A mapping from each file name to the list of directories containing it.
+    """
+    dirs = {file_name: [] for file_name in file_names}
+    visited = set()
+    stack = [root]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            dir_stat = stat(current_dir)
+            dir_id = (dir_stat.st_dev, dir_stat.st_ino)
+            if dir_id in visited:
+                continue
+            visited.add(dir_id)
+            entries = scandir(current_dir)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.name in dirs:
+                    dirs[entry.name].append(current_dir)
+    return dirs
+
+
+@lru_cache(maxsize=None)
+def _get_yaml():
+    # round-trip mode is needed to keep the explanatory comments of the template in the info cards
+    return ruamel.yaml.YAML()
+
+
+@lru_cache(maxsize=None)
+def _load_template(template_file):
+    # parsed only once per process, callers must copy the result before modifying it
+    with open(template_file, "r") as f:
+        return _get_yaml().load(f)
+
+
+def _get_folder_name(adapter_data):
+    return (
+        f"{adapter_data['model_name']}_{adapter_data['task']}_{adapter_data['subtask']}_{adapter_data['config_name']}"
+    ).translate(FOLDER_NAME_TRANSLATION)
+
+
+def _pack_adapter_worker(
+    folder, save_root, template_file, adapter_data, metadata=None, version="1", url_template=None
+):
+    """Zips the given adapter folder and creates its info card. Runs in a worker process without user interaction.
+
+    Returns:
+        str: The name of the created zip file and info card (without extension).
+    """
+    # zip adapter folder to destination
+    folder_name = _get_folder_name(adapter_data)
+    zip_name = join(save_root, "{}.zip".format(folder_name))
+    # the checksums are calculated while writing, so the zip doesn't have to be read again
+    buffer = bytearray(CHUNK_SIZE)
+    has_head = False
+    with open(zip_name, "wb") as f:
+        writer = _HashingWriter(f, ["sha1", "sha256"])
+        with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zipf:
+            with scandir(folder) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    if entry.name == "head_config.json":
+                        has_head = True
+                    zip_info = zipfile.ZipInfo.from_file(entry.path, arcname=entry.name)
+                    with open(entry.path, "rb") as src, zipf.open(zip_info, "w") as dst:
+                        _copy_file(src, dst, buffer)
+    sha1 = writer.hashes["sha1"].hexdigest()
+    sha256 = writer.hashes["sha256"].hexdigest()
+    # add description file
+    # use url template if available
+    if url_template:
+        download_url = url_template.format(file=basename(zip_name), **adapter_data)
+    else:
+        download_url = "TODO"
+    file_info = {"version": version, "url": download_url, "sha1": sha1, "sha256": sha256}
+    # load the template and fill in data
+    template = copy.deepcopy(_load_template(template_file))
+    for key in adapter_data:
+        if key in template and key != "config":
+            template[key] = adapter_data[key]
+    template["files"] = [file_info]
+    template["default_version"] = version
+    template["config"] = {
+        "using": adapter_data["config_name"],
+        "non_linearity": adapter_data["config"]["non_linearity"],
+        "reduction_factor": adapter_data["config"]["reduction_factor"],
+    }
+    template["prediction_head"] = has_head
+    # optionally add provided metadata
+    if metadata:
+        for k, v in metadata.items():
+            template[k] = v
+    # save and finish
+    with open(join(save_root, "{}.yaml".format(folder_name)), "w") as f:
+        _get_yaml().dump(template, f)
+    return folder_name
+
 
 def adapter_pack_command_factory(args: Namespace):
     return AdapterPackCommand(args.input_paths, args.output_path, args.template, not args.no_extract)
@@ -69,30 +226,53 @@ class AdapterPackCommand(BaseTransformersCLICommand):
         self.extract_from_models = extract_from_models
         self._validate_func = lambda x: len(x) > 0 or "This field must not be empty."
         self._input_cache = {}
-        # create a lookup map for default configs
-        self._config_id_lookup = {}
-        for k, v in ADAPTER_CONFIG_MAP.items():
-            config_hash = get_adapter_config_hash(v)
-            self._config_id_lookup[config_hash] = k
+        # lookup map for default configs, created on first use
+        self._config_id_lookup = None
+
+    def _lookup_config_name(self, config_id):
+        if self._config_id_lookup is None:
+            self._config_id_lookup = {}
+            for k, v in ADAPTER_CONFIG_MAP.items():
+                config_hash = get_adapter_config_hash(v)
+                self._config_id_lookup[config_hash] = k
+        return self._config_id_lookup.get(config_id, "")
 
     def find_models_and_adapters(self) -> List:
         # full models and adapters are identified by their weights file
-        models_list = []
+        # both are collected in a single walk over each input path
+        file_names = [ADAPTER_WEIGHTS_NAME]
         if self.extract_from_models:
-            for input_path in self.input_paths:
-                for weights_file in glob.glob(join(input_path, "**", WEIGHTS_NAME), recursive=True):
-                    models_list.append(dirname(weights_file))
+            file_names.append(WEIGHTS_NAME)
+        models_list = []
         adapters_list = []
         for input_path in self.input_paths:
-            for weights_file in glob.glob(join(input_path, "**", ADAPTER_WEIGHTS_NAME), recursive=True):
-                adapters_list.append(dirname(weights_file))
+            found = _find_dirs_containing(input_path, file_names)
+            models_list.extend(found.get(WEIGHTS_NAME, []))
+            adapters_list.extend(found[ADAPTER_WEIGHTS_NAME])
         return models_list, adapters_list
 
+    def load_extract_cache(self) -> Mapping:
+        # the cache is only an optimization, so an unreadable cache file is treated as empty
+        try:
+            with open(ADAPTER_EXTRACT_CACHE_FILE, "rb") as f:
+                extract_cache = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+        return extract_cache if isinstance(extract_cache, dict) else {}
+
+    def save_extract_cache(self, extract_cache: Mapping):
+        makedirs(ADAPTER_CACHE, exist_ok=True)
+        # write to a temporary file first, so an interrupted write can't leave a truncated cache behind
+        tmp_file = ADAPTER_EXTRACT_CACHE_FILE + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(extract_cache))
+        replace(tmp_file, ADAPTER_EXTRACT_CACHE_FILE)
+
     def ask_for_metadata(self) -> Mapping:
         metadata_config = {}
         if isfile(ADAPTER_PACK_METADATA_FILE):
-            with open(ADAPTER_PACK_METADATA_FILE, "r") as f:
-                metadata_config = json.load(f)
+            with open(ADAPTER_PACK_METADATA_FILE, "rb") as f:
+                metadata_config = orjson.loads(f.read())
         inputs = [
             {
                 "type": "input",
@@ -134,11 +314,20 @@ class AdapterPackCommand(BaseTransformersCLICommand):
             },
         ]
         answers = prompt(inputs)
-        with open(ADAPTER_PACK_METADATA_FILE, "w") as f:
-            json.dump(answers, f)
+        with open(ADAPTER_PACK_METADATA_FILE, "wb") as f:
+            f.write(orjson.dumps(answers))
         return answers
 
-    def ask_for_adapter_type(self) -> Mapping:
+    def ask_for_adapter_inputs(self, folder, adapter_data=None) -> Mapping:
+        adapter_data = adapter_data or {}
+        # load config from folder and add it to data
+        with open(join(folder, "adapter_config.json"), "rb") as f:
+            config = orjson.loads(f.read())
+        for k, v in config.items():
+            adapter_data[k] = v
+        # ask for all missing data in a single prompt
+        has_type = bool(adapter_data.get("type", None))
+        has_model_name = bool(adapter_data.get("model_name", None))
         inputs = [
             {
                 "type": "list",
@@ -148,13 +337,8 @@ class AdapterPackCommand(BaseTransformersCLICommand):
                     {"value": "text_task", "name": "Task"},
                     {"value": "text_lang", "name": "Language"},
                 ],
-            }
-        ]
-        answers = prompt(inputs)
-        return answers
-
-    def ask_for_adapter_data(self) -> Mapping:
-        inputs = [
+                "when": lambda _: not has_type,
+            },
             {
                 "type": "input",
                 "name": "task",
@@ -167,107 +351,28 @@ class AdapterPackCommand(BaseTransformersCLICommand):
                 "message": "The identifier of the subtask:",
                 "validate": self._validate_func,
             },
-        ]
-        answers = prompt(inputs)
-        return answers
-
-    def ask_for_adapter_config(self, config_id):
-        inputs = [
             {
                 "type": "input",
                 "name": "config_name",
                 "message": "The name of the adapter config:",
                 "validate": self._validate_func,
-                "default": self._config_id_lookup.get(config_id, ""),
+                "default": self._lookup_config_name(adapter_data["config_id"]),
             },
-        ]
-        answers = prompt(inputs)
-        return answers
-
-    def ask_for_model_name(self):
-        print("[i] We couldn't find a model name in this adapter's config. Please specify one.")
-        inputs = [
             {
                 "type": "input",
                 "name": "model_name",
-                "message": "Identifier of the pre-trained model:",
+                "message": "Identifier of the pre-trained model (not found in the adapter config):",
                 "validate": self._validate_func,
                 "default": self._input_cache.get("model_name", ""),
-            }
+                "when": lambda _: not has_model_name,
+            },
         ]
         answers = prompt(inputs)
-        self._input_cache["model_name"] = answers["model_name"]
-        return answers
-
-    def pack_adapter(
-        self, folder, save_root, template_file, adapter_data=None, metadata=None, version="1", url_template=None
-    ):
-        adapter_data = adapter_data or {}
-        # load config from folder and add it to data
-        with open(join(folder, "adapter_config.json"), "r") as f:
-            config = json.load(f)
-        for k, v in config.items():
-            adapter_data[k] = v
-        # ask for type if not given
-        if not adapter_data.get("type", None):
-            for k, v in self.ask_for_adapter_type().items():
-                adapter_data[k] = v
-        # ask for data from user if not given
-        for k, v in self.ask_for_adapter_data().items():
+        if "model_name" in answers:
+            self._input_cache["model_name"] = answers["model_name"]
+        for k, v in answers.items():
             adapter_data[k] = v
-        # ask for config name
-        for k, v in self.ask_for_adapter_config(adapter_data["config_id"]).items():
-            adapter_data[k] = v
-        # ask for model name if we couldn't find it
-        if not adapter_data.get("model_name", None):
-            for k, v in self.ask_for_model_name().items():
-                adapter_data[k] = v
-        # zip adapter folder to destination
-        folder_name = "_".join(
-            [adapter_data["model_name"], adapter_data["task"], adapter_data["subtask"], adapter_data["config_name"]]
-        )
-        folder_name = folder_name.replace("/", "-")
-        zip_name = join(save_root, "{}.zip".format(folder_name))
-        print("Zipping {} to {}...".format(folder, zip_name))
-        zipf = zipfile.ZipFile(zip_name, "w")
-        for file in listdir(folder):
-            zipf.write(join(folder, file), arcname=file)
-        zipf.close()
-        # add description file
-        # calculate the hash of the zip file
-        with open(zip_name, "rb") as f:
-            file_bytes = f.read()
-            sha1 = hashlib.sha1(file_bytes).hexdigest()
-            sha256 = hashlib.sha256(file_bytes).hexdigest()
-        # use url template if available
-        if url_template:
-            download_url = url_template.format(file=basename(zip_name), **adapter_data)
-        else:
-            download_url = "TODO"
-        file_info = {"version": version, "url": download_url, "sha1": sha1, "sha256": sha256}
-        # load the template and fill in data
-        yaml = ruamel.yaml.YAML()
-        with open(template_file, "r") as f:
-            template = yaml.load(f)
-        for key in adapter_data:
-            if key in template and key != "config":
-                template[key] = adapter_data[key]
-        template["files"] = [file_info]
-        template["default_version"] = version
-        template["config"] = {
-            "using": adapter_data["config_name"],
-            "non_linearity": adapter_data["config"]["non_linearity"],
-            "reduction_factor": adapter_data["config"]["reduction_factor"],
-        }
-        template["prediction_head"] = exists(join(folder, "head_config.json"))
-        # optionally add provided metadata
-        if metadata:
-            for k, v in metadata.items():
-                template[k] = v
-        # save and finish
-        with open(join(save_root, "{}.yaml".format(folder_name)), "w") as f:
-            yaml.dump(template, f)
-        print(Fore.GREEN + f"✔ Created info card for {folder_name}")
+        return adapter_data
 
     def print_finalization_text(self):
         print(Fore.CYAN + "=" * 10 + " Step 3: Finalization & Upload " + "=" * 10)
@@ -302,15 +407,52 @@ class AdapterPackCommand(BaseTransformersCLICommand):
         metadata = self.ask_for_metadata()
         url_template = metadata.pop("adapter_url_template")
         print("Thanks! Now let's start...")
+        # first collect all user inputs, ...
+        adapter_inputs = []
+        # each output file must only be written by one worker
+        folders_by_name = {}
         for i, folder in enumerate(folders):
             print(Fore.CYAN + f"[Adapter {i+1} of {len(folders)}] {folder}")
             try:
-                self.pack_adapter(
-                    folder, save_root, template_file, metadata=metadata, version=version, url_template=url_template
-                )
+                adapter_data = self.ask_for_adapter_inputs(folder)
+                folder_name = _get_folder_name(adapter_data)
             except Exception as ex:
                 print(Fore.RED + "✘ Failed to pack adapter")
                 print(Fore.RED + str(ex))
+                continue
+            if folder_name in folders_by_name:
+                print(Fore.RED + f"✘ Skipping adapter, {folder_name} is already used by another adapter")
+                print(Fore.RED + f"(in {folders_by_name[folder_name]})")
+                print(Fore.RED + "Please pack it again with a different task, subtask or config name.")
+                continue
+            folders_by_name[folder_name] = folder
+            adapter_inputs.append((folder, adapter_data))
+        # ... then pack all adapters in parallel
+        if adapter_inputs:
+            print(f"Zipping {len(adapter_inputs)} adapters to {save_root}...")
+            with ProcessPoolExecutor(max_workers=min(len(adapter_inputs), cpu_count() or 1)) as executor:
+                # submit the largest adapters first so that no single long hashing job is left at the end
+                futures = [None] * len(adapter_inputs)
+                folder_sizes = [_folder_size(folder) for folder, _ in adapter_inputs]
+                for i in sorted(range(len(adapter_inputs)), key=lambda i: folder_sizes[i], reverse=True):
+                    folder, adapter_data = adapter_inputs[i]
+                    futures[i] = executor.submit(
+                        _pack_adapter_worker,
+                        folder,
+                        save_root,
+                        template_file,
+                        adapter_data,
+                        metadata=metadata,
+                        version=version,
+                        url_template=url_template,
+                    )
+                for (folder, _), future in zip(adapter_inputs, futures):
+                    try:
+                        folder_name = future.result()
+                        print(Fore.GREEN + f"✔ Created info card for {folder_name}")
+                    except Exception as ex:
+                        print(Fore.RED + f"✘ Failed to pack adapter in {folder}")
+                        print(Fore.RED + str(ex))
         self.print_finalization_text()
 
     def run(self):
@@ -339,11 +481,31 @@ class AdapterPackCommand(BaseTransformersCLICommand):
             return
         # extract adapters from all models
         elif answers["mode"] == "extract":
+            extract_cache = self.load_extract_cache()
+            # extracted paths are absolute, so compare against the absolute paths of the found adapters
+            known_adapter_paths = {abspath(adapter_path) for adapter_path in adapters_list}
             for model_dir in models_list:
-                print(f"Extracting adapters from model in {model_dir} ...")
-                # TODO use the correct model class
-                model = AutoModel.from_pretrained(model_dir)
-                for adapter_path in model.save_all_adapters(model_dir):
-                    if adapter_path not in adapters_list:
+                cache_key = abspath(model_dir)
+                weights_mtime = stat(join(model_dir, WEIGHTS_NAME)).st_mtime_ns
+                cached = extract_cache.get(cache_key)
+                if (
+                    isinstance(cached, dict)
+                    and cached.get("mtime") == weights_mtime
+                    and isinstance(cached.get("adapters"), list)
+                    and all(isdir(adapter_path) for adapter_path in cached["adapters"])
+                ):
+                    print(f"Reusing adapters previously extracted from model in {model_dir}")
+                    extracted_paths = cached["adapters"]
+                else:
+                    print(f"Extracting adapters from model in {model_dir} ...")
+                    # TODO use the correct model class
+                    model = AutoModel.from_pretrained(model_dir)
+                    # absolute paths keep the cache valid independent of the working directory
+                    extracted_paths = [abspath(path) for path in model.save_all_adapters(model_dir)]
+                    extract_cache[cache_key] = {"mtime": weights_mtime, "adapters": extracted_paths}
+                for adapter_path in extracted_paths:
+                    if adapter_path not in known_adapter_paths:
+                        known_adapter_paths.add(adapter_path)
                         adapters_list.append(adapter_path)
+            self.save_extract_cache(extract_cache)
         self.pack_adapters_interactive(adapters_list, self.output_path)
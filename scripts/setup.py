@@ -16,6 +16,7 @@ setup(
         "adapter-transformers",
         # for pack
         "colorama",
+        "orjson",
         "PyInquirer",
         "ruamel.yaml",
         # for check